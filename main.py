@@ -1,16 +1,82 @@
-from fastapi import FastAPI, HTTPException, Header, Query, Request
-from pydantic import BaseModel, EmailStr
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Header, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from pydantic import AfterValidator, BaseModel, ConfigDict, EmailStr, StringConstraints
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Optional
-import requests
+from typing import Annotated, NamedTuple, Optional
+import asyncio
+import atexit
+import base64
+import functools
+import hashlib
+import hmac
+import httpx
 import json
+import mmap
 import os
-import urllib.request
-import urllib.error
-import urllib.parse
-import secrets
+import re
+import sqlite3
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:  # opcional: sem orjson tudo cai no json da stdlib
+    orjson = None
+
+try:
+    from ciso8601 import parse_datetime as _ciso_parse
+except ImportError:  # opcional: sem ciso8601 usa datetime.fromisoformat
+    _ciso_parse = None
+
+class ORJSONResponse(JSONResponse):
+    """Resposta padrão serializada com orjson (o ORJSONResponse do FastAPI está deprecated)."""
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    if not _LICENSE_SECRET:
+        print("[WARN] ENVIFORGE_LICENSE_SECRET não definido: licenças sem assinatura HMAC.")
+    _ensure_storage()
+    _migrate_legacy_json()
+    # e-mails, log de ativação e lotes do Supabase saem por aqui, no event loop
+    app.state.http = httpx.AsyncClient(
+        http2=True, timeout=10.0, limits=httpx.Limits(max_keepalive_connections=64)
+    )
+    log_task = _start_admin_log_writer()
+    sb_task = _start_supabase_worker(app.state.http)
+    ckpt_task = asyncio.create_task(_wal_checkpointer())
+    yield
+    ckpt_task.cancel()
+    await _stop_supabase_worker(sb_task)
+    await _stop_admin_log_writer(log_task)
+    await app.state.http.aclose()
+    _HTTP.close()
+    _STORE.close()
+
+app = FastAPI(title="Enviforge License API", lifespan=_lifespan, default_response_class=ORJSONResponse)
+
+@app.exception_handler(StarletteHTTPException)
+async def _http_exception_handler(request: Request, exc: StarletteHTTPException) -> Response:
+    """Mesmo corpo do handler padrão ({"detail": ...}), mas serializado com orjson."""
+    headers = getattr(exc, "headers", None)
+    if exc.status_code in (204, 304) or exc.status_code < 200:
+        return Response(status_code=exc.status_code, headers=headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
 
-app = FastAPI(title="Enviforge License API")
+# =========================
+# HTTP de saída (Resend, Supabase)
+# =========================
+# Um client só, thread-safe: keep-alive + pool, sem handshake TLS por chamada.
+# Fica para os caminhos síncronos (fallback do Supabase sem worker, mail_test);
+# o resto usa o AsyncClient de app.state.http, criado no lifespan.
+_HTTP = httpx.Client(http2=True, timeout=10.0, limits=httpx.Limits(max_keepalive_connections=32))
 
 # =========================
 # Email (Resend) - transacional
@@ -20,10 +86,17 @@ RESEND_API_KEY = os.getenv("RESEND_API_KEY", "").strip()
 MAIL_FROM = os.getenv("MAIL_FROM", "Enviforge <no-reply@enviforge.com>").strip()
 MAIL_ENABLED = os.getenv("MAIL_ENABLED", "false").strip().lower() in ("1", "true", "yes", "on")
 
+# URL e headers fixos: montados uma vez; as conexões ficam no pool dos clients
+RESEND_EMAILS_URL = "https://api.resend.com/emails"
+_RESEND_HEADERS = {
+    "Authorization": f"Bearer {RESEND_API_KEY}",
+    "Content-Type": "application/json",
+}
+
 def _mail_should_send() -> bool:
     return bool(MAIL_ENABLED and RESEND_API_KEY and "@" in MAIL_FROM)
 
-def _resend_send_email(*, to_email: str, subject: str, html: str, text: str) -> None:
+async def _resend_send_email(client: httpx.AsyncClient, *, to_email: str, subject: str, html: str, text: str) -> None:
     """Envia e-mail via Resend. Não levanta exceção para o fluxo principal."""
     if not _mail_should_send():
         return
@@ -34,54 +107,42 @@ def _resend_send_email(*, to_email: str, subject: str, html: str, text: str) ->
         "html": html,
         "text": text,
     }
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        url="https://api.resend.com/emails",
-        data=data,
-        headers={
-            "Authorization": f"Bearer {RESEND_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        method="POST",
-    )
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            # força leitura para lançar erros HTTP se houver body de erro
-            resp.read()
-    except urllib.error.HTTPError as e:
-        try:
-            body = e.read().decode("utf-8", errors="replace")
-        except Exception:
-            body = "<no-body>"
-        print(f"[mail] resend HTTPError status={getattr(e, 'code', None)} to={to_email} subject={subject!r} body={body}")
-    except urllib.error.URLError as e:
+        r = await client.post(RESEND_EMAILS_URL, content=_dump_json(payload), headers=_RESEND_HEADERS, timeout=15)
+        if r.status_code >= 400:
+            print(f"[mail] resend HTTPError status={r.status_code} to={to_email} subject={subject!r} body={r.text}")
+    except httpx.TransportError as e:
         print(f"[mail] resend URLError to={to_email} subject={subject!r}: {e}")
     except Exception as e:
         # Nunca travar ativação por falha de e-mail
         print(f"[mail] resend failed to={to_email} subject={subject!r}: {e}")
 
+# Textos por tipo de licença, montados uma vez no import.
+_SUBJECT_TEMPLATES: dict[str, str] = {
+    "trial": "Sua licença de teste do {product} (30 dias)",
+    "owner": "Sua licença do {product} está ativa",
+    "paid": "Sua licença do {product} está ativa",
+    "enterprise": "Sua licença empresarial do {product} está ativa",
+}
+_DEFAULT_SUBJECT = "Sua licença do {product}"
+
+_EMAIL_REASONS: dict[str, str] = {
+    "TRIAL": "Você solicitou o teste do aplicativo.",
+    "PAID": "Sua licença foi emitida/ativada.",
+    "ENTERPRISE": "Sua licença empresarial foi emitida/ativada.",
+    "OWNER": "Sua licença foi emitida/ativada.",
+}
+_DEFAULT_REASON = "Sua licença foi emitida/ativada."
+
 def _license_email_subject(*, product: str, license_type: str) -> str:
     lt = (license_type or "").lower()
-    if lt == "trial":
-        return f"Sua licença de teste do {product} (30 dias)"
-    if lt == "owner":
-        return f"Sua licença do {product} está ativa"
-    if lt == "paid":
-        return f"Sua licença do {product} está ativa"
-    if lt == "enterprise":
-        return f"Sua licença empresarial do {product} está ativa"
-    return f"Sua licença do {product}"
+    return _SUBJECT_TEMPLATES.get(lt, _DEFAULT_SUBJECT).format(product=product)
 
 def _license_email_bodies(*, product: str, license_type: str, license_key: str, expires_at_iso: str | None) -> tuple[str, str]:
     """Retorna (html, text). Simples, copy/paste, sem Machine ID."""
     lt = (license_type or "").upper()
     exp_line = expires_at_iso or "-"
-    reason = {
-        "TRIAL": "Você solicitou o teste do aplicativo.",
-        "PAID": "Sua licença foi emitida/ativada.",
-        "ENTERPRISE": "Sua licença empresarial foi emitida/ativada.",
-        "OWNER": "Sua licença foi emitida/ativada.",
-    }.get(lt, "Sua licença foi emitida/ativada.")
+    reason = _EMAIL_REASONS.get(lt, _DEFAULT_REASON)
 
     html = f"""<!doctype html>
 <html lang='pt-BR'>
@@ -113,7 +174,7 @@ def _license_email_bodies(*, product: str, license_type: str, license_key: str,
     )
     return html, text
 
-def _try_send_license_email(*, to_email: str | None, product: str, license_type: str, license_key: str, expires_at_iso: str | None) -> None:
+async def _try_send_license_email(client: httpx.AsyncClient, *, to_email: str | None, product: str, license_type: str, license_key: str, expires_at_iso: str | None) -> None:
     if not to_email:
         return
     to_email_norm = _email_norm(to_email)
@@ -121,85 +182,561 @@ def _try_send_license_email(*, to_email: str | None, product: str, license_type:
         return
     subject = _license_email_subject(product=product, license_type=license_type)
     html, txt = _license_email_bodies(product=product, license_type=license_type, license_key=license_key, expires_at_iso=expires_at_iso)
-    _resend_send_email(to_email=to_email_norm, subject=subject, html=html, text=txt)
+    await _resend_send_email(client, to_email=to_email_norm, subject=subject, html=html, text=txt)
 
 # =========================
-# Storage simples (JSON local no Render)
+# Storage simples (SQLite + JSON local no Render)
 # =========================
 DATA_DIR = os.getenv("DATA_DIR", "/tmp")
 
-TRIALS_PATH = os.path.join(DATA_DIR, "trials.json")       # já existe (trial/owner)
-LICENSES_PATH = os.path.join(DATA_DIR, "licenses.json")   # NOVO (paid + seats + cooldown)
+DB_PATH = os.path.join(DATA_DIR, "enviforge.db")          # trials + licenses (paid)
+TRIALS_PATH = os.path.join(DATA_DIR, "trials.json")       # legado: importado no SQLite no startup
+LICENSES_PATH = os.path.join(DATA_DIR, "licenses.json")   # legado: importado no SQLite no startup
 
 COOLDOWN_DAYS = 7
 
 def _ensure_storage() -> None:
+    """Uma vez, no startup (lifespan)."""
     os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(TRIALS_PATH):
-        with open(TRIALS_PATH, "w", encoding="utf-8") as f:
-            json.dump({}, f, ensure_ascii=False, indent=2)
-    if not os.path.exists(LICENSES_PATH):
-        with open(LICENSES_PATH, "w", encoding="utf-8") as f:
-            json.dump({}, f, ensure_ascii=False, indent=2)
+
+def _dump_json(data: dict) -> bytes:
+    """Serializa para bytes UTF-8 compacto (orjson, ou json se não instalado)."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _parse_json(raw) -> dict:
+    """Aceita bytes/str/memoryview."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw if isinstance(raw, (bytes, str)) else bytes(raw))
 
 def _load_json(path: str) -> dict:
-    _ensure_storage()
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    """Lê um JSON legado inteiro (só usado na migração do startup)."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}   # mmap não aceita arquivo vazio
+        # mmap: o parser lê direto do page cache, sem cópia do arquivo inteiro em bytes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return _parse_json(view)
+
+_TRIAL_FIELDS = ("product", "license", "issued_at", "expires_at", "expires_at_epoch", "plan", "license_type")
+_TRIAL_COLS = ", ".join(_TRIAL_FIELDS)
+
+class _Store:
+    """
+    Trials (chave machine_id) e licenças paid (chave = texto da licença) em
+    SQLite (WAL). Leitura é lookup na PK e gravação toca só a linha alterada,
+    em vez de reescrever o JSON inteiro a cada request. Uma conexão só,
+    compartilhada pelas threads do threadpool e serializada pelo lock.
+    """
 
-def _save_json(path: str, data: dict) -> None:
-    _ensure_storage()
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()   # reentrante: get/put dentro de write_tx
+        self._conn: sqlite3.Connection | None = None
+
+    def _db(self) -> sqlite3.Connection:
+        # chamar com self.lock; conecta no primeiro uso (o import não toca o disco)
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS trials (
+                    machine_id       TEXT PRIMARY KEY,
+                    product          TEXT,
+                    license          TEXT,
+                    issued_at        TEXT,
+                    expires_at       TEXT,
+                    expires_at_epoch INTEGER,
+                    plan             TEXT,
+                    license_type     TEXT
+                )
+                """
+            )
+            # bancos criados antes da coluna de epoch
+            cols = {r["name"] for r in conn.execute("PRAGMA table_info(trials)")}
+            if "expires_at_epoch" not in cols:
+                conn.execute("ALTER TABLE trials ADD COLUMN expires_at_epoch INTEGER")
+                conn.executemany(
+                    "UPDATE trials SET expires_at_epoch = ? WHERE machine_id = ?",
+                    [(_iso_to_epoch(r["expires_at"]), r["machine_id"])
+                     for r in conn.execute("SELECT machine_id, expires_at FROM trials")],
+                )
+            # licenças paid: registro inteiro em JSON; product/email (normalizado)
+            # em colunas para as buscas por email/produto
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS licenses (
+                    key              TEXT PRIMARY KEY,
+                    product          TEXT,
+                    email            TEXT,
+                    data             BLOB NOT NULL,
+                    expires_at_epoch INTEGER
+                )
+                """
+            )
+            # validade em coluna: pull_license descarta as expiradas no próprio SELECT
+            cols = {r["name"] for r in conn.execute("PRAGMA table_info(licenses)")}
+            if "expires_at_epoch" not in cols:
+                conn.execute("ALTER TABLE licenses ADD COLUMN expires_at_epoch INTEGER")
+                conn.executemany(
+                    "UPDATE licenses SET expires_at_epoch = ? WHERE key = ?",
+                    [((_rec_expiry(_parse_json(r["data"])) or (None,))[0], r["key"])
+                     for r in conn.execute("SELECT key, data FROM licenses")],
+                )
+            # pull_license / delete_license buscam por email (+ produto): índice em vez de scan
+            conn.execute("CREATE INDEX IF NOT EXISTS licenses_email_idx ON licenses(email, product)")
+            # máquinas de cada licença (machine_id principal + active_mids), para
+            # delete_by_mid achar as licenças pelo índice em vez de abrir todos os JSON
+            has_seats = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'license_seats'"
+            ).fetchone()
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS license_seats (
+                    key        TEXT NOT NULL,
+                    machine_id TEXT NOT NULL,
+                    PRIMARY KEY (key, machine_id)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS license_seats_mid_idx ON license_seats(machine_id)")
+            # chaves paid que saíram da tabela (self_recover / admin delete): o texto
+            # continua passando no parse + MAC, então o /validate consulta esta lista
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS revoked_licenses (
+                    key        TEXT PRIMARY KEY,
+                    revoked_at TEXT
+                ) WITHOUT ROWID
+                """
+            )
+            if not has_seats:
+                # bancos criados antes da tabela: preenche a partir dos registros
+                conn.execute("BEGIN")
+                for key, data in conn.execute("SELECT key, data FROM licenses").fetchall():
+                    self._sync_seats(conn, key, _parse_json(data))
+                conn.execute("COMMIT")
+            self._conn = conn
+        return self._conn
+
+    def _in_tx(self, fn):
+        # chamar com self.lock; fn(db) roda dentro de BEGIN/COMMIT
+        # (dentro de um write_tx já aberto, só roda: o commit é do write_tx)
+        db = self._db()
+        if db.in_transaction:
+            return fn(db)
+        db.execute("BEGIN")
+        try:
+            out = fn(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return out
+
+    @contextmanager
+    def write_tx(self):
+        """
+        Read-modify-write atômico (ex.: consumir seat). Segura o lock e a trava
+        de escrita do SQLite (BEGIN IMMEDIATE), então serializa também entre
+        workers do uvicorn. Exceção dentro do bloco (HTTPException inclusive) = rollback.
+        Não fazer I/O de rede aqui dentro.
+        """
+        with self.lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def get_trial(self, machine_id: str) -> dict | None:
+        with self.lock:
+            row = self._db().execute(
+                f"SELECT {_TRIAL_COLS} FROM trials WHERE machine_id = ?", (machine_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def trial_meta(self, machine_id: str, license_text: str) -> tuple[str | None, str | None] | None:
+        """plan/license_type do trial, só se a licença gravada for exatamente esta."""
+        with self.lock:
+            row = self._db().execute(
+                "SELECT plan, license_type FROM trials WHERE machine_id = ? AND license = ?",
+                (machine_id, license_text),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def upsert_trial(self, machine_id: str, rec: dict, *, only_new: bool = False) -> bool:
+        """
+        Grava o registro. Se já existir, mantém o issued_at da primeira emissão.
+        only_new: só insere (trial novo); False se outro request/worker já gravou
+        esta máquina, e aí quem chama relê a linha em vez de sobrescrever a licença.
+        """
+        conflict = "DO NOTHING" if only_new else """DO UPDATE SET
+                    product = excluded.product,
+                    license = excluded.license,
+                    issued_at = COALESCE(trials.issued_at, excluded.issued_at),
+                    expires_at = excluded.expires_at,
+                    expires_at_epoch = excluded.expires_at_epoch,
+                    plan = excluded.plan,
+                    license_type = excluded.license_type"""
+        with self.lock:
+            cur = self._db().execute(
+                f"""
+                INSERT INTO trials (machine_id, {_TRIAL_COLS})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(machine_id) {conflict}
+                """,
+                (machine_id, *(rec.get(k) for k in _TRIAL_FIELDS)),
+            )
+        return cur.rowcount == 1
+
+    def delete_trial(self, machine_id: str) -> dict | None:
+        """Remove e devolve o registro removido (None se não existia)."""
+        with self.lock:
+            db = self._db()
+            row = db.execute(
+                f"SELECT {_TRIAL_COLS} FROM trials WHERE machine_id = ?", (machine_id,)
+            ).fetchone()
+            if row:
+                db.execute("DELETE FROM trials WHERE machine_id = ?", (machine_id,))
+        return dict(row) if row else None
+
+    def import_trials(self, trials: dict) -> int:
+        """Importa {machine_id: registro} sem sobrescrever o que já está no banco."""
+        rows = []
+        for mid, rec in trials.items():
+            if not isinstance(rec, dict):
+                continue
+            rec = {**rec, "expires_at_epoch": _iso_to_epoch(rec.get("expires_at"))}
+            rows.append((mid, *(rec.get(k) for k in _TRIAL_FIELDS)))
+        with self.lock:
+            self._in_tx(lambda db: db.executemany(
+                f"INSERT OR IGNORE INTO trials (machine_id, {_TRIAL_COLS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            ))
+        return len(rows)
+
+    # ---- licenças paid ----
+
+    @staticmethod
+    def _license_row(key: str, rec: dict) -> tuple:
+        exp = _rec_expiry(rec)
+        return (key, rec.get("product"), _email_norm(rec.get("email")), _dump_json(rec),
+                exp[0] if exp else None)
+
+    @staticmethod
+    def _sync_seats(db: sqlite3.Connection, key: str, rec: dict | None) -> None:
+        # chamar dentro de transação; rec None = licença removida
+        db.execute("DELETE FROM license_seats WHERE key = ?", (key,))
+        if not rec:
+            return
+        mids = {(rec.get("machine_id") or "").strip(), *(rec.get("active_mids") or [])}
+        mids.discard("")
+        db.executemany(
+            "INSERT INTO license_seats (key, machine_id) VALUES (?, ?)",
+            [(key, m) for m in mids],
+        )
+
+    def license_state(self, key: str) -> tuple[dict | None, bool]:
+        """(registro paid ou None, revogada?) num acesso só ao lock, para o /validate."""
+        with self.lock:
+            db = self._db()
+            row = db.execute("SELECT data FROM licenses WHERE key = ?", (key,)).fetchone()
+            if row:
+                return _parse_json(row[0]), False
+            revoked = db.execute("SELECT 1 FROM revoked_licenses WHERE key = ?", (key,)).fetchone()
+        return None, revoked is not None
+
+    def get_license(self, key: str) -> dict | None:
+        with self.lock:
+            row = self._db().execute("SELECT data FROM licenses WHERE key = ?", (key,)).fetchone()
+        return _parse_json(row[0]) if row else None
+
+    def find_licenses(self, product: str, email: str | None = None,
+                      valid_at: float | None = None) -> list[tuple[str, dict]]:
+        """
+        [(key, registro)] do produto (e do email normalizado, se informado), em ordem de criação.
+        valid_at (epoch): só as que não expiraram até esse instante.
+        """
+        sql = "SELECT key, data FROM licenses WHERE product = ?"
+        args: tuple = (product,)
+        if email is not None:
+            sql += " AND email = ?"
+            args += (email,)
+        if valid_at is not None:
+            sql += " AND expires_at_epoch >= ?"
+            args += (valid_at,)
+        with self.lock:
+            rows = self._db().execute(sql + " ORDER BY rowid", args).fetchall()
+        return [(r[0], _parse_json(r[1])) for r in rows]
+
+    def put_license(self, key: str, rec: dict) -> None:
+        def _put(db):
+            db.execute(
+                """
+                INSERT INTO licenses (key, product, email, data, expires_at_epoch) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    product = excluded.product,
+                    email = excluded.email,
+                    data = excluded.data,
+                    expires_at_epoch = excluded.expires_at_epoch
+                """,
+                self._license_row(key, rec),
+            )
+            self._sync_seats(db, key, rec)
+
+        with self.lock:
+            self._in_tx(_put)
+
+    def rekey_license(self, old_key: str, new_key: str, rec: dict) -> bool:
+        """
+        Troca a chave da licença num UPDATE só (nunca ficam as duas válidas;
+        mantém o rowid, então a ordem de criação não muda). False se old_key não existe.
+        """
+        _, product, email, data, exp_epoch = self._license_row(new_key, rec)
+
+        def _rekey(db):
+            cur = db.execute(
+                "UPDATE licenses SET key = ?, product = ?, email = ?, data = ?, expires_at_epoch = ? WHERE key = ?",
+                (new_key, product, email, data, exp_epoch, old_key),
+            )
+            if cur.rowcount != 1:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO revoked_licenses (key, revoked_at) VALUES (?, ?)",
+                (old_key, _utcnow_iso()),
+            )
+            self._sync_seats(db, old_key, None)
+            self._sync_seats(db, new_key, rec)
+            return True
+
+        with self.lock:
+            return self._in_tx(_rekey)
+
+    def delete_licenses_matching(self, product: str, *, email: str | None = None,
+                                 machine_id: str | None = None) -> list[str]:
+        """
+        Apaga as licenças do produto por email (normalizado) ou por máquina
+        (principal/ativa) numa transação só, sem decodificar os JSON. Chaves apagadas, em ordem de criação.
+        """
+        if machine_id is not None:
+            sql = (
+                "SELECT l.key FROM license_seats s JOIN licenses l ON l.key = s.key"
+                " WHERE s.machine_id = ? AND l.product = ? ORDER BY l.rowid"
+            )
+            args: tuple = (machine_id, product)
+        else:
+            sql = "SELECT key FROM licenses WHERE email = ? AND product = ? ORDER BY rowid"
+            args = (email, product)
+
+        def _delete(db):
+            keys = [r[0] for r in db.execute(sql, args)]
+            if keys:
+                self.delete_licenses(keys)
+            return keys
+
+        with self.lock:
+            return self._in_tx(_delete)
+
+    def delete_licenses(self, keys: list[str]) -> int:
+        def _delete(db):
+            params = [(k,) for k in keys]
+            now = _utcnow_iso()
+            db.executemany(
+                "INSERT OR REPLACE INTO revoked_licenses (key, revoked_at) SELECT key, ? FROM licenses WHERE key = ?",
+                [(now, k) for k in keys],
+            )
+            db.executemany("DELETE FROM license_seats WHERE key = ?", params)
+            return db.executemany("DELETE FROM licenses WHERE key = ?", params)
+
+        with self.lock:
+            cur = self._in_tx(_delete)
+        return cur.rowcount
+
+    def import_licenses(self, licenses: dict) -> int:
+        """Importa {license_key: registro} sem sobrescrever o que já está no banco."""
+        items = [(k, rec) for k, rec in licenses.items() if isinstance(rec, dict)]
+
+        def _import(db):
+            for k, rec in items:
+                cur = db.execute(
+                    "INSERT OR IGNORE INTO licenses (key, product, email, data, expires_at_epoch) VALUES (?, ?, ?, ?, ?)",
+                    self._license_row(k, rec),
+                )
+                if cur.rowcount:
+                    self._sync_seats(db, k, rec)
+
+        with self.lock:
+            self._in_tx(_import)
+        return len(items)
+
+    def checkpoint(self) -> tuple[int, int, int]:
+        """
+        Copia o WAL para o banco e zera o arquivo -wal. (busy, páginas no WAL, copiadas)
+        Conexão própria, fora do self.lock e com busy timeout 0: com leitor aberto
+        (outro worker) volta busy=1 na hora, em vez de segurar o store por 5s.
+        """
+        if not os.path.exists(self.path):
+            return (0, 0, 0)
+        conn = sqlite3.connect(self.path, timeout=0, isolation_level=None)
+        try:
+            return tuple(conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone())
+        finally:
+            conn.close()
 
-def _load_trials() -> dict:
-    return _load_json(TRIALS_PATH)
+    def close(self) -> None:
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
 
-def _save_trials(data: dict) -> None:
-    _save_json(TRIALS_PATH, data)
+_STORE = _Store(DB_PATH)
 
-def _load_licenses() -> dict:
-    return _load_json(LICENSES_PATH)
+# O auto-checkpoint do SQLite (1000 páginas) não encolhe o -wal; a task zera o
+# arquivo de tempos em tempos para ele não crescer sem limite no disco do Render.
+WAL_CHECKPOINT_EVERY = 300  # segundos
 
-def _save_licenses(data: dict) -> None:
-    _save_json(LICENSES_PATH, data)
+async def _wal_checkpointer() -> None:
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_EVERY)
+        try:
+            busy, _, _ = await run_in_threadpool(_STORE.checkpoint)
+            if busy:
+                print("[storage] wal_checkpoint: banco ocupado, tenta no próximo ciclo")
+        except Exception as e:
+            print(f"[WARN] wal_checkpoint falhou: {e!r}")
+
+def _migrate_legacy_json() -> None:
+    """Startup: importa trials.json/licenses.json legados (se existirem) e renomeia para .migrated."""
+    for path, importer in ((TRIALS_PATH, _STORE.import_trials), (LICENSES_PATH, _STORE.import_licenses)):
+        if not os.path.exists(path):
+            continue
+        name = os.path.basename(path)
+        try:
+            n = importer(_load_json(path))
+            os.replace(path, path + ".migrated")
+            print(f"[storage] {name} migrado para SQLite: {n} registros")
+        except Exception as e:
+            # não derruba o startup; tenta de novo no próximo boot
+            print(f"[WARN] migração do {name} falhou: {e!r}")
+
+# Relógio grosso: reaproveita o mesmo "agora" por até 1s (validades são em dias).
+# Tupla (monotonic, datetime, iso) trocada numa atribuição só, sem lock.
+# NÃO usar para nada que precise ser único (token/nonce).
+_NOW_CACHE: tuple[float, datetime, str] | None = None
+
+def _now_cached() -> tuple[float, datetime, str]:
+    global _NOW_CACHE
+    m = time.monotonic()
+    cached = _NOW_CACHE
+    if cached is None or m - cached[0] >= 1.0:
+        dt = datetime.now(timezone.utc)
+        cached = _NOW_CACHE = (m, dt, dt.isoformat())
+    return cached
 
 def _utcnow() -> datetime:
-    return datetime.now(timezone.utc)
+    return _now_cached()[1]
+
+def _utcnow_iso() -> str:
+    return _now_cached()[2]
+
+def _fromiso(ts: str) -> datetime:
+    """ISO 8601 -> datetime. ciso8601 (C) quando disponível; formato que ele recusa cai no fromisoformat."""
+    if _ciso_parse is not None:
+        try:
+            return _ciso_parse(ts)
+        except ValueError:
+            pass
+    return datetime.fromisoformat(ts)
 
 def _parse_dt(ts: str | None) -> datetime | None:
     if not ts:
         return None
     try:
-        dt = datetime.fromisoformat(ts)
+        dt = _fromiso(ts)
         if dt.tzinfo is None:
             dt = dt.replace(tzinfo=timezone.utc)
         return dt
     except Exception:
         return None
+
+def _iso_to_epoch(ts: str | None) -> int | None:
+    dt = _parse_dt(ts)
+    return int(dt.timestamp()) if dt else None
+
+def _rec_expiry(rec: dict) -> tuple[int, str] | None:
+    """
+    (epoch, iso) da validade de um registro.
+    Usa expires_at_epoch quando existe; registros antigos caem no parse do ISO.
+    """
+    epoch = rec.get("expires_at_epoch")
+    if epoch is not None:
+        return int(epoch), rec.get("expires_at")
+    dt = _parse_dt(rec.get("expires_at"))
+    if not dt:
+        return None
+    return int(dt.timestamp()), dt.isoformat()
 # =========================
-# Supabase - Log de ativação
+# Filas em background (admin log, Supabase)
 # =========================
 
-SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
+def _enqueue(loop: asyncio.AbstractEventLoop | None, q: asyncio.Queue | None, item) -> bool:
+    """
+    Põe item na fila de um worker, vindo do loop ou de thread do threadpool.
+    False se o worker não está rodando (quem chama faz o caminho síncrono).
+    """
+    if q is None or loop is None:
+        return False
+    try:
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            q.put_nowait(item)
+        else:
+            loop.call_soon_threadsafe(q.put_nowait, item)
+        return True
+    except RuntimeError:
+        return False  # loop já fechado
+
+# =========================
+# Supabase - config (compartilhada por log de ativação e upsert)
+# =========================
+
+SUPABASE_URL = os.getenv("SUPABASE_URL", "").strip().rstrip("/")
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "").strip()
+
+def _supabase_enabled() -> bool:
+    return bool(SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY)
 
-def _try_log_activation_event(license_key: str, machine_id: str, activated_by: str | None, event: str):
-    print("LOG ACTIVATION EVENT DISPARADO")
+# =========================
+# Supabase - Log de ativação
+# =========================
+
+async def _try_log_activation_event(client: httpx.AsyncClient, license_key: str, machine_id: str, activated_by: str | None, event: str):
     """
     Registra evento de ativação no Supabase.
-    Não derruba a API se falhar.
+    Não derruba a API se falhar. Não loga headers (levam a service role key).
     """
-    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
-        print("WARN: Supabase não configurado.")
-    
+    if not _supabase_enabled():
         return
 
     try:
         url = f"{SUPABASE_URL}/rest/v1/license_activations"
         headers = {
-            "apikey": SUPABASE_SERVICE_KEY,
-            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+            "apikey": SUPABASE_SERVICE_ROLE_KEY,
+            "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
             "Content-Type": "application/json",
             "Prefer": "return=minimal",
         }
@@ -213,26 +750,108 @@ def _try_log_activation_event(license_key: str, machine_id: str, activated_by: s
 
         # Remove campos None
         payload = {k: v for k, v in payload.items() if v is not None}
-        print("Enviando para Supabase:", url)
-        print("Headers:", headers)
-        print("Payload:", payload)
-        r = requests.post(url, headers=headers, json=payload, timeout=10)
+        r = await client.post(url, headers=headers, content=_dump_json(payload), timeout=10)
 
         if r.status_code not in (200, 201, 204):
-            print("WARN: Supabase log falhou:", r.status_code, r.text)
+            print(f"[WARN] Supabase log falhou: {r.status_code} {r.text[:200]}")
 
     except Exception as e:
-        print("WARN: Supabase log exception:", repr(e))
+        print(f"[WARN] Supabase log exception: {e!r}")
 
 
 # =========================
 # Supabase (REST) - Upsert em public.licenses
 # =========================
-SUPABASE_URL = os.getenv("SUPABASE_URL", "").strip()
-SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "").strip()
 
-def _supabase_enabled() -> bool:
-    return bool(SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY)
+_SUPABASE_UPSERT_URL = f"{SUPABASE_URL}/rest/v1/licenses?on_conflict=machine_id,product"
+
+def _supabase_upsert_headers() -> dict:
+    return {
+        "Content-Type": "application/json",
+        "apikey": SUPABASE_SERVICE_ROLE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+        "Prefer": "resolution=merge-duplicates",
+    }
+
+# Upserts vão para uma fila; um worker manda em lote (PostgREST aceita array)
+# até SUPABASE_BATCH linhas ou SUPABASE_BATCH_WAIT s depois da primeira.
+SUPABASE_BATCH = 100
+SUPABASE_BATCH_WAIT = 0.1
+# lote que falhou por rede/5xx/429 é reenviado com backoff exponencial (0.5s, 1s, 2s);
+# nesse meio tempo a fila acumula e o próximo lote sai maior
+SUPABASE_RETRIES = 3
+SUPABASE_RETRY_BASE = 0.5
+_SUPABASE_Q: asyncio.Queue | None = None
+_SUPABASE_LOOP: asyncio.AbstractEventLoop | None = None
+
+def _supabase_dedupe(rows: list[dict]) -> list[dict]:
+    # mesma (machine_id, product) duas vezes no lote quebra o ON CONFLICT: fica a última
+    last = {}
+    for row in rows:
+        last[(row["machine_id"], row["product"])] = row
+    return list(last.values())
+
+async def _supabase_post_batch(client: httpx.AsyncClient, rows: list[dict]) -> None:
+    content = _dump_json(_supabase_dedupe(rows))
+    for attempt in range(SUPABASE_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(SUPABASE_RETRY_BASE * 2 ** (attempt - 1))
+        try:
+            r = await client.post(_SUPABASE_UPSERT_URL, content=content, headers=_supabase_upsert_headers())
+        except httpx.TransportError as e:
+            err = repr(e)
+        except Exception as e:
+            # Não quebra o trial. Só loga no Render.
+            print(f"[WARN] Supabase upsert failed: {e!r} ({len(rows)} linhas)")
+            return
+        else:
+            if r.status_code < 300:
+                return
+            err = f"{r.status_code} {r.text[:200]}"
+            if r.status_code < 500 and r.status_code != 429:
+                break  # payload recusado: reenviar não adianta
+    print(f"[WARN] Supabase upsert failed: {err} ({len(rows)} linhas)")
+
+async def _supabase_worker(q: asyncio.Queue, client: httpx.AsyncClient) -> None:
+    # None na fila = shutdown: manda o lote corrente e sai
+    loop = asyncio.get_running_loop()
+    stop = False
+    while not stop:
+        row = await q.get()
+        if row is None:
+            break
+        rows = [row]
+        deadline = loop.time() + SUPABASE_BATCH_WAIT
+        while len(rows) < SUPABASE_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(q.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stop = True
+                break
+            rows.append(row)
+        await _supabase_post_batch(client, rows)
+
+def _start_supabase_worker(client: httpx.AsyncClient) -> asyncio.Task | None:
+    # client: o AsyncClient compartilhado (HTTP/2 + keep-alive, um lote não paga handshake novo)
+    global _SUPABASE_Q, _SUPABASE_LOOP
+    if not _supabase_enabled():
+        return None
+    _SUPABASE_Q = asyncio.Queue()
+    _SUPABASE_LOOP = asyncio.get_running_loop()
+    return asyncio.create_task(_supabase_worker(_SUPABASE_Q, client))
+
+async def _stop_supabase_worker(task: asyncio.Task | None) -> None:
+    global _SUPABASE_Q
+    if task is None:
+        return
+    q, _SUPABASE_Q = _SUPABASE_Q, None
+    q.put_nowait(None)
+    await task
 
 def _supabase_upsert_license(*, machine_id: str, product: str, license_key: str,
                              expires_at: str | None, status: str,
@@ -240,12 +859,12 @@ def _supabase_upsert_license(*, machine_id: str, product: str, license_key: str,
     """
     UPSERT em public.licenses usando REST (PostgREST) do Supabase.
     Requer índice/constraint UNIQUE(machine_id, product).
-    Best-effort: se falhar, não interrompe o trial.
+    Best-effort: se falhar, não interrompe o trial. Não bloqueia: enfileira
+    para o worker; sem worker rodando, faz o POST síncrono.
     """
     if not _supabase_enabled():
         return
 
-    url = f"{SUPABASE_URL}/rest/v1/licenses?on_conflict=machine_id,product"
     payload = {
         "machine_id": machine_id,
         "product": product,
@@ -255,24 +874,14 @@ def _supabase_upsert_license(*, machine_id: str, product: str, license_key: str,
         "email": email,
         "seats_total": seats_total,
     }
-
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        url=url,
-        data=data,
-        method="POST",
-        headers={
-            "Content-Type": "application/json",
-            "apikey": SUPABASE_SERVICE_ROLE_KEY,
-            "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-            "Prefer": "resolution=merge-duplicates",
-        },
-    )
+    if _enqueue(_SUPABASE_LOOP, _SUPABASE_Q, payload):
+        return
 
     try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            # 201/204 normalmente
-            _ = resp.read()
+        r = _HTTP.post(_SUPABASE_UPSERT_URL, content=_dump_json(payload), headers=_supabase_upsert_headers())
+        # 201/204 normalmente
+        if r.status_code >= 300:
+            print(f"[WARN] Supabase upsert failed: {r.status_code} {r.text[:200]}")
     except Exception as e:
         # Não quebra o trial. Só loga no Render.
         print(f"[WARN] Supabase upsert failed: {e}")
@@ -282,126 +891,298 @@ def _supabase_upsert_license(*, machine_id: str, product: str, license_key: str,
 # =========================
 OWNER_MIDS_RAW = os.getenv("ENVIFORGE_OWNER_MIDS", "").strip()
 
-def _owner_set() -> set[str]:
-    if not OWNER_MIDS_RAW:
-        return set()
-    items = [x.strip() for x in OWNER_MIDS_RAW.split(",")]
-    return {x for x in items if x}
+# env var não muda em runtime: monta o conjunto uma vez no import
+_OWNER_SET: frozenset[str] = frozenset(x.strip() for x in OWNER_MIDS_RAW.split(",") if x.strip())
 
-def _is_owner(machine_id: str) -> bool:
-    return machine_id.strip() in _owner_set()
+# machine_id chega como o app mandou (só e-mails são normalizados no parse):
+# quem chama passa o id já aparado, _is_owner(req.machine_id.strip())
+_is_owner = _OWNER_SET.__contains__
 
 OWNER_DAYS = 365 * 20  # 20 anos (aprox) = 7300 dias
 
+# =========================
+# Base dos modelos de request
+# =========================
+# Limites checados pelo pydantic-core (Rust) antes do endpoint rodar:
+# lixo/payload gigante é rejeitado com 422 sem alocar nada do nosso lado.
+# extra fica no default (ignore): apps desktop já instalados podem mandar campos a mais.
+MachineId = Annotated[str, StringConstraints(min_length=1, max_length=128)]
+LicenseText = Annotated[str, StringConstraints(min_length=1, max_length=512)]
+# admin / master key: aqui o valor sempre foi aparado; só espaço -> 422 do min_length
+StrippedMachineId = Annotated[MachineId, StringConstraints(strip_whitespace=True)]
+StrippedLicenseText = Annotated[LicenseText, StringConstraints(strip_whitespace=True)]
+# e-mail normalizado no parse (strip + lower): endpoint usa req.email direto.
+# Só e-mail: machine_id/licença são comparados como foram gravados (com espaços, se vieram assim).
+EmailNorm = Annotated[str, StringConstraints(strip_whitespace=True, to_lower=True)]
+NewEmail = Annotated[EmailStr, AfterValidator(str.lower)]   # só onde o e-mail entra no sistema (EmailStr já faz o strip)
+
+class _RequestModel(BaseModel):
+    model_config = ConfigDict(str_max_length=256)
+
 # =========================
 # Admin (RESET TRIAL) - protegido por token
 # =========================
 ADMIN_TOKEN = os.getenv("ENVIFORGE_ADMIN_TOKEN", "").strip()
+_ADMIN_TOKEN_BYTES = ADMIN_TOKEN.encode("utf-8")
 ADMIN_LOG_PATH = os.path.join(DATA_DIR, "admin_resets.log")
 
+# Handle único do log (O_APPEND, sem buffer do Python), aberto no primeiro uso.
+_ADMIN_LOG_LOCK = threading.Lock()
+_ADMIN_LOG_FH = None
+
+def _admin_log_fh():
+    # chamar com _ADMIN_LOG_LOCK
+    global _ADMIN_LOG_FH
+    if _ADMIN_LOG_FH is None:
+        _ADMIN_LOG_FH = open(ADMIN_LOG_PATH, "ab", buffering=0)
+        atexit.register(_ADMIN_LOG_FH.close)
+    return _ADMIN_LOG_FH
+
+def _write_admin_log(lines: list[bytes]) -> None:
+    # writev: o lote sai num syscall só, sem concatenar as linhas antes
+    try:
+        with _ADMIN_LOG_LOCK:
+            fd = _admin_log_fh().fileno()
+            n = os.writev(fd, lines)
+            total = sum(map(len, lines))
+            if n < total:  # write curto (raro em arquivo): grava o resto
+                os.write(fd, b"".join(lines)[n:])
+    except Exception:
+        pass
+
+# Writer em background: o request só enfileira; a task junta até
+# ADMIN_LOG_BATCH linhas por write. Sem a task rodando, grava direto.
+ADMIN_LOG_BATCH = 100
+_ADMIN_LOG_Q: asyncio.Queue | None = None
+_ADMIN_LOG_LOOP: asyncio.AbstractEventLoop | None = None
+
+async def _admin_log_writer(q: asyncio.Queue) -> None:
+    while True:
+        batch = [await q.get()]
+        while len(batch) < ADMIN_LOG_BATCH:
+            try:
+                batch.append(q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        _write_admin_log(batch)
+
+def _start_admin_log_writer() -> asyncio.Task:
+    global _ADMIN_LOG_Q, _ADMIN_LOG_LOOP
+    _ADMIN_LOG_Q = asyncio.Queue()
+    _ADMIN_LOG_LOOP = asyncio.get_running_loop()
+    return asyncio.create_task(_admin_log_writer(_ADMIN_LOG_Q))
+
+async def _stop_admin_log_writer(task: asyncio.Task) -> None:
+    global _ADMIN_LOG_Q
+    q, _ADMIN_LOG_Q = _ADMIN_LOG_Q, None
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    # o que sobrou na fila, em lotes (writev tem limite de IOV_MAX linhas)
+    rest = []
+    while q is not None and not q.empty():
+        rest.append(q.get_nowait())
+    for i in range(0, len(rest), ADMIN_LOG_BATCH):
+        _write_admin_log(rest[i:i + ADMIN_LOG_BATCH])
+
 def _log_admin(action: str, machine_id: str, detail: dict | None = None) -> None:
-    """Log simples em arquivo (auditoria)."""
-    _ensure_storage()
+    """Log simples em arquivo (auditoria). Não bloqueia: enfileira para o writer."""
     payload = {
-        "ts": _utcnow().isoformat(),
+        "ts": _utcnow_iso(),
         "action": action,
         "machine_id": machine_id,
         "detail": detail or {},
     }
     try:
-        with open(ADMIN_LOG_PATH, "a", encoding="utf-8") as f:
-            f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        line = _dump_json(payload) + b"\n"
     except Exception:
-        pass
+        return
 
-class AdminResetRequest(BaseModel):
-    machine_id: str
+    if not _enqueue(_ADMIN_LOG_LOOP, _ADMIN_LOG_Q, line):
+        _write_admin_log([line])
+
+class AdminResetRequest(_RequestModel):
+    machine_id: MachineId
     product: str = "psicrocalc"
     reason: str | None = None
 
 # =========================
 # Modelos
 # =========================
-class TrialRequest(BaseModel):
-    machine_id: str
+class TrialRequest(_RequestModel):
+    machine_id: MachineId
     product: str = "psicrocalc"
     email: str | None = None
 
-class RecoverRequest(BaseModel):
-    machine_id: str
+class RecoverRequest(_RequestModel):
+    machine_id: MachineId
     product: str = "psicrocalc"
 
-class ValidateRequest(BaseModel):
-    machine_id: str
+class ValidateRequest(_RequestModel):
+    machine_id: MachineId
     product: str = "psicrocalc"
-    license: str
+    # aparada no parse: o lookup paid/revogada usa o mesmo texto que o _parse_license
+    # (licença colada do e-mail com espaço/\n não pode escapar da lista de revogadas)
+    license: StrippedLicenseText
 
-class ActivateRequest(BaseModel):
-    machine_id: str
-    email: str
+class ActivateRequest(_RequestModel):
+    machine_id: MachineId
+    email: NewEmail
     product: str = "psicrocalc"
     seats_total: int = 1
     days: int = 365  # default 1 ano (ajuste depois)
 
-class SelfRecoverRequest(BaseModel):
-    license: str
-    email: str
-    new_machine_id: str
+class SelfRecoverRequest(_RequestModel):
+    license: LicenseText
+    email: EmailNorm
+    new_machine_id: MachineId
     product: str = "psicrocalc"
 
-class PullLicenseMasterRequest(BaseModel):
-    license: str
-    machine_id: str
-    activated_by: Optional[str] = None  # e-mail TI opcional
+class PullLicenseMasterRequest(_RequestModel):
+    license: StrippedLicenseText
+    machine_id: MachineId
+    activated_by: Optional[EmailNorm] = None  # e-mail TI opcional
     product: str = "psicrocalc"
 
 # =========================
 # Helpers de licença
 # =========================
+# Pool de bytes aleatórios: um os.urandom(4096) atende ~170 licenças em vez
+# de uma syscall por licença. Continua sendo saída do CSPRNG do kernel.
+LICENSE_TOKEN_BYTES = 24   # mesmo tamanho do antigo secrets.token_urlsafe(24)
+_RAND_POOL_SIZE = 4096
+_RAND_BUF = bytearray()
+_RAND_LOCK = threading.Lock()
+
+def _take_random(n: int) -> bytes:
+    with _RAND_LOCK:
+        if len(_RAND_BUF) < n:
+            _RAND_BUF.extend(os.urandom(_RAND_POOL_SIZE))
+        out = bytes(_RAND_BUF[:n])
+        del _RAND_BUF[:n]
+    return out
+
+def _reset_random_pool() -> None:
+    # processo filho não pode herdar o pool (tokens repetidos entre workers)
+    global _RAND_BUF, _RAND_LOCK
+    _RAND_BUF = bytearray()
+    _RAND_LOCK = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_random_pool)
+
+# Assinatura: token = nonce(8) + HMAC-SHA256(product|machine_id|exp_iso|nonce)[:16].
+# Mesmos 24 bytes / 32 chars do token aleatório antigo, então o formato não muda.
+# Sem ENVIFORGE_LICENSE_SECRET o token volta a ser só aleatório (sem verificação).
+_LICENSE_SECRET = os.getenv("ENVIFORGE_LICENSE_SECRET", "").strip().encode("utf-8")
+LICENSE_NONCE_BYTES = 8
+LICENSE_MAC_BYTES = LICENSE_TOKEN_BYTES - LICENSE_NONCE_BYTES
+
+def _license_mac(product: str, machine_id: str, exp_iso: str, nonce: bytes) -> bytes:
+    msg = f"{product}|{machine_id}|{exp_iso}|".encode("utf-8") + nonce
+    return hmac.new(_LICENSE_SECRET, msg, "sha256").digest()[:LICENSE_MAC_BYTES]
+
+def _license_token(product: str, machine_id: str, exp_iso: str) -> str:
+    if _LICENSE_SECRET:
+        nonce = _take_random(LICENSE_NONCE_BYTES)
+        raw = nonce + _license_mac(product, machine_id, exp_iso, nonce)
+    else:
+        raw = _take_random(LICENSE_TOKEN_BYTES)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _license_mac_ok(product: str, machine_id: str, exp_iso: str, token: str) -> bool | None:
+    """None: sem segredo configurado (nada a verificar)."""
+    if not _LICENSE_SECRET:
+        return None
+    # decode estrito: urlsafe_b64decode ignora caracteres fora do alfabeto, e aí
+    # vários textos diferentes passariam como o mesmo token assinado
+    try:
+        raw = base64.b64decode(token + "=" * (-len(token) % 4), altchars=b"-_", validate=True)
+    except Exception:
+        return False
+    if len(raw) != LICENSE_TOKEN_BYTES:
+        return False
+    # só a forma canônica (a que _license_token gera) é aceita
+    if base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii") != token:
+        return False
+    nonce, mac = raw[:LICENSE_NONCE_BYTES], raw[LICENSE_NONCE_BYTES:]
+    return hmac.compare_digest(mac, _license_mac(product, machine_id, exp_iso, nonce))
+
+LICENSE_PREFIX = "ENVIFORGE|"
+
+def _license_text(product: str, machine_id: str, exp_iso: str) -> str:
+    # um f-string só; o prefixo é constante de módulo
+    return f"{LICENSE_PREFIX}{product}|{machine_id}|{exp_iso}|{_license_token(product, machine_id, exp_iso)}"
+
 def _make_license(machine_id: str, product: str, days: int = 30) -> str:
     """
     Licença simples (MVP):
     ENVIFORGE|<product>|<machine_id>|<exp_iso>|<token>
     """
-    exp = (_utcnow() + timedelta(days=days)).isoformat()
-    token = secrets.token_urlsafe(24)
-    return f"ENVIFORGE|{product}|{machine_id}|{exp}|{token}"
+    return _license_text(product, machine_id, (_utcnow() + timedelta(days=days)).isoformat())
 
 def _make_license_with_exp(machine_id: str, product: str, exp: datetime) -> str:
+    # datetime aware (o caso normal) vai direto, sem replace
     if exp.tzinfo is None:
         exp = exp.replace(tzinfo=timezone.utc)
+    return _license_text(product, machine_id, exp.isoformat())
 
-    token = secrets.token_urlsafe(24)
-    return f"ENVIFORGE|{product}|{machine_id}|{exp.isoformat()}|{token}"
+class ParsedLicense(NamedTuple):
+    """Imutável: a mesma instância sai do cache para todos os requests."""
+    product: str
+    machine_id: str
+    exp: datetime
+    exp_epoch: int          # /validate compara int
+    exp_iso: str            # já normalizado, sem re-serializar
+    token: str
+    mac_ok: bool | None     # MAC sobre o exp_iso como veio no texto (é o que foi assinado)
 
-def _parse_license(license_text: str) -> dict:
-    parts = license_text.strip().split("|")
-    if len(parts) != 5 or parts[0] != "ENVIFORGE":
-        raise ValueError("invalid format")
+# PREFIX|product|machine_id|exp_iso|token, num match só (sem fatiar a string)
+_LICENSE_RE = re.compile(re.escape(LICENSE_PREFIX) + r"([^|]*)\|([^|]*)\|([^|]*)\|([^|]*)")
 
-    product = parts[1]
-    machine_id = parts[2]
-    exp_iso = parts[3]
-    token = parts[4]
+@functools.lru_cache(maxsize=8192)
+def _parse_license(license_text: str) -> ParsedLicense:
+    """
+    Resultado em cache por texto de licença: o /validate recebe a mesma
+    licença a cada abertura do app.
+    """
+    # strip mantido: a licença costuma ser colada do e-mail
+    m = _LICENSE_RE.fullmatch(license_text.strip())
+    if m is None:
+        raise ValueError("invalid format")
+    product, machine_id, exp_iso, token = m.groups()
 
-    exp = datetime.fromisoformat(exp_iso)
+    exp = _fromiso(exp_iso)
     if exp.tzinfo is None:
         exp = exp.replace(tzinfo=timezone.utc)
 
-    return {"product": product, "machine_id": machine_id, "exp": exp, "token": token}
+    return ParsedLicense(
+        product=product,
+        machine_id=machine_id,
+        exp=exp,
+        exp_epoch=int(exp.timestamp()),
+        exp_iso=exp.isoformat(),
+        token=token,
+        mac_ok=_license_mac_ok(product, machine_id, exp_iso, token),
+    )
 
-def _record_and_return(trials: dict, machine_id: str, product: str, lic: str, plan: str, license_type: str, email: str | None = None):
+def _record_and_return(machine_id: str, product: str, lic: str, plan: str, license_type: str,
+                       email: str | None = None, *, bg: BackgroundTasks, only_new: bool = False):
+    """None se only_new e a máquina já tinha registro (nada gravado, nada enviado)."""
     parsed = _parse_license(lic)
-    exp_iso = parsed["exp"].isoformat()
-    trials[machine_id] = {
+    exp_iso = parsed.exp_iso
+    stored = _STORE.upsert_trial(machine_id, {
         "product": product,
         "license": lic,
-        "issued_at": trials.get(machine_id, {}).get("issued_at") or _utcnow().isoformat(),
+        "issued_at": _utcnow_iso(),  # upsert preserva o issued_at original
         "expires_at": exp_iso,
+        "expires_at_epoch": parsed.exp_epoch,
         "plan": plan,
         "license_type": license_type,
-    }
-    _save_trials(trials)
+    }, only_new=only_new)
+    if not stored:
+        return None
 
     # --- grava também no Supabase (UPSERT) ---
     # status no banco: "trial" ou "owner" (ou "active" no futuro)
@@ -416,14 +1197,17 @@ def _record_and_return(trials: dict, machine_id: str, product: str, lic: str, pl
         seats_total=None,
     )
 
-    # --- e-mail transacional (backup) ---
-    _try_send_license_email(
-        to_email=email,
-        product=product,
-        license_type=str(license_type).lower(),
-        license_key=lic,
-        expires_at_iso=exp_iso,
-    )
+    # --- e-mail transacional (backup): depois da resposta ---
+    if email:
+        bg.add_task(
+            _try_send_license_email,
+            app.state.http,
+            to_email=email,
+            product=product,
+            license_type=str(license_type).lower(),
+            license_key=lic,
+            expires_at_iso=exp_iso,
+        )
 
     return {
         "license": lic,
@@ -443,62 +1227,84 @@ def _seats_used(rec: dict) -> int:
 # =========================
 # Health
 # =========================
+# payload constante: serializa uma vez no import (monitores batem aqui o tempo todo)
+_HEALTH_BYTES = _dump_json({"ok": True})
+
 @app.get("/")
-def root():
-    return {"ok": True}
+@app.get("/health")
+async def root():
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
 
 # =========================
 # Trial 30 dias (idempotente) + Owner 20 anos
 # =========================
+# /trial em andamento por machine_id (single-flight, por processo): um retry
+# que chega enquanto o primeiro ainda grava espera o mesmo resultado em vez de
+# emitir de novo (e mandar outro e-mail / upsert)
+_TRIAL_INFLIGHT: dict[str, asyncio.Future] = {}
+
+def _consume_exception(fut: asyncio.Future) -> None:
+    # sem seguidor esperando, o asyncio reclamaria de exceção nunca lida
+    if not fut.cancelled():
+        fut.exception()
+
 @app.post("/trial")
-def trial(req: TrialRequest):
+async def trial(req: TrialRequest, bg: BackgroundTasks):
     """
     Trial 30 dias:
     - Se já existe trial e ainda NÃO expirou: retorna o mesmo (idempotente).
     - Se já existe mas expirou: retorna 409 trial_used.
     Owner (ENVIFORGE_OWNER_MIDS):
     - Retorna licença de 20 anos (não consome trial).
+    Emissão (gravação + Supabase) é bloqueante e roda no threadpool; o e-mail
+    sai em background depois da resposta.
+    Requests simultâneos da mesma máquina recebem a resposta (ou o erro) do primeiro.
     """
-    trials = _load_trials()
+    pending = _TRIAL_INFLIGHT.get(req.machine_id)
+    if pending is not None:
+        # shield: se este request cair, não cancela o do outro
+        return await asyncio.shield(pending)
+
+    fut = asyncio.get_running_loop().create_future()
+    fut.add_done_callback(_consume_exception)
+    _TRIAL_INFLIGHT[req.machine_id] = fut
+    try:
+        body = await _trial(req, bg)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    else:
+        fut.set_result(body)
+        return body
+    finally:
+        del _TRIAL_INFLIGHT[req.machine_id]
 
-    # Owner sempre ganha 20 anos
-    if _is_owner(req.machine_id):
-        existing = trials.get(req.machine_id) or {}
-        lic = existing.get("license")
-        exp_iso = existing.get("expires_at")
-        exp_dt = _parse_dt(exp_iso)
-
-        # Se já tem licença owner válida, reaproveita. Senão, emite de novo.
-        if lic and exp_dt and _utcnow() <= exp_dt:
-            return {
-                "license": lic,
-                "expires_at": exp_dt.isoformat(),
-                "machine_id": req.machine_id,
-                "product": req.product,
-                "plan": existing.get("plan") or "owner",
-                "license_type": existing.get("license_type") or "owner",
-            }
+async def _trial(req: TrialRequest, bg: BackgroundTasks) -> dict:
+    existing = await run_in_threadpool(_STORE.get_trial, req.machine_id)
 
-        lic = _make_license(machine_id=req.machine_id, product=req.product, days=OWNER_DAYS)
-        return _record_and_return(trials, req.machine_id, req.product, lic, plan="owner", license_type="owner")
+    # Owner sempre ganha 20 anos
+    if _is_owner(req.machine_id.strip()):
+        return await _issue_or_get_owner(existing, req.machine_id, req.product, bg)
 
     # Trial normal
-    if req.machine_id in trials:
-        existing = trials[req.machine_id]
-        exp_dt = _parse_dt(existing.get("expires_at"))
+    if existing is not None:
+        exp = _rec_expiry(existing)
 
         # se por algum motivo não tem exp válida, trata como usado
-        if not exp_dt:
+        if not exp:
             raise HTTPException(
                 status_code=409,
                 detail={"message": "Teste grátis já utilizado nesta máquina.", "expires_at": existing.get("expires_at")},
             )
 
         # idempotente se ainda válido
-        if _utcnow() <= exp_dt:
+        if time.time() <= exp[0]:
             return {
                 "license": existing.get("license"),
-                "expires_at": exp_dt.isoformat(),
+                "expires_at": exp[1],
                 "machine_id": req.machine_id,
                 "product": existing.get("product") or req.product,
                 "plan": existing.get("plan") or "trial",
@@ -515,83 +1321,117 @@ def trial(req: TrialRequest):
             },
         )
 
+    body = await run_in_threadpool(_issue_trial, req, bg)
+    if body is None:
+        # perdeu a corrida para outro worker: responde com o trial que ficou gravado
+        return await _trial(req, bg)
+    return body
+
+async def _issue_or_get_owner(existing: dict | None, machine_id: str, product: str,
+                              bg: BackgroundTasks) -> dict:
+    """
+    Owner: reaproveita a licença se ainda válida, senão emite de novo.
+    existing = registro já lido do store (/trial e /recover_license leem uma vez só).
+    """
+    lic = existing.get("license") if existing is not None else None
+    exp = _rec_expiry(existing) if lic else None
+
+    if exp and time.time() <= exp[0]:
+        return {
+            "license": lic,
+            "expires_at": exp[1],
+            "machine_id": machine_id,
+            "product": product,
+            "plan": existing.get("plan") or "owner",
+            "license_type": existing.get("license_type") or "owner",
+        }
+
+    lic = _make_license(machine_id=machine_id, product=product, days=OWNER_DAYS)
+    return await run_in_threadpool(
+        _record_and_return, machine_id, product, lic, plan="owner", license_type="owner", bg=bg
+    )
+
+def _issue_trial(req: TrialRequest, bg: BackgroundTasks) -> dict | None:
+    """
+    Emite trial novo. Sync: grava e faz upsert no Supabase (e-mail via bg).
+    None se outro worker gravou o trial desta máquina entre o get_trial e aqui.
+    """
     lic = _make_license(machine_id=req.machine_id, product=req.product, days=30)
 
-    resp = _record_and_return(
-        trials,
+    return _record_and_return(
         req.machine_id,
         req.product,
         lic,
         plan="trial",
         license_type="trial",
-        email=req.email
+        email=req.email,
+        bg=bg,
+        only_new=True,
     )
-    
-    # Envio de e-mail (best effort): NÃO pode quebrar a emissão da licença
-    try:
-        mail_enabled = (os.getenv("MAIL_ENABLED") or "").strip().lower() == "true"
-        mail_from = (os.getenv("MAIL_FROM") or "").strip()
-        resend_api_key = (os.getenv("RESEND_API_KEY") or "").strip()
-    
-        if mail_enabled and mail_from and resend_api_key and req.email:
-            r = requests.post(
-                "https://api.resend.com/emails",
-                headers={
-                    "Authorization": f"Bearer {resend_api_key}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "from": mail_from,
-                    "to": [req.email],
-                    "subject": "Sua licença Trial Enviforge",
-                    "text": (
-                        "Enviforge — licença Trial\n\n"
-                        f"Licença: {resp.get('license')}\n"
-                        f"Validade: {resp.get('expires_at')}\n"
-                        f"Produto: {resp.get('product')}\n"
-                    ),
-                },
-                timeout=20,
-            )
-    
-            # opcional: guardar retorno pra debug sem atrapalhar o app
-            resp["mail"] = {"status": r.status_code}
-            try:
-                resp["mail"]["body"] = r.json()
-            except Exception:
-                resp["mail"]["body"] = r.text
-    
-    except Exception as e:
-        resp["mail"] = {"error": str(e)}
-    
-    return resp
-    
+
 # =========================
 # Recover (recuperar licença desta máquina)
 # =========================
 
+@functools.lru_cache(maxsize=4096)
+def _license_etag(license_text: str, machine_id: str, expires_at: str, plan: str, license_type: str) -> str:
+    h = hashlib.sha256(
+        f"{license_text}|{machine_id}|{expires_at}|{plan}|{license_type}".encode("utf-8")
+    ).hexdigest()[:16]
+    return f'"{h}"'
+
+# o app pode reaproveitar a resposta por 60s sem perguntar de novo; depois, If-None-Match
+LICENSE_CACHE_CONTROL = "private, max-age=60"
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(t.strip().removeprefix("W/") in (etag, "*") for t in if_none_match.split(","))
+
+def _with_etag(body: dict, if_none_match: str, license_text: str | None = None) -> Response:
+    """
+    Cliente faz polling: se a resposta não mudou, 304 sem corpo.
+    license_text: para corpos sem o campo "license" (/validate).
+    """
+    etag = _license_etag(
+        license_text or body.get("license") or "",
+        body.get("machine_id") or "",
+        body.get("expires_at") or "",
+        body.get("plan") or "",
+        body.get("license_type") or "",
+    )
+    headers = {"ETag": etag, "Cache-Control": LICENSE_CACHE_CONTROL}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(body, headers=headers)
+
 @app.post("/recover_license")
-def recover_license(req: RecoverRequest):
+async def recover_license(
+    req: RecoverRequest,
+    bg: BackgroundTasks,
+    if_none_match: str = Header(default=""),
+):
     """
     Recupera a licença já emitida para este machine_id, se ainda estiver válida.
     - Owner: garante 20 anos (idempotente).
     - Trial: se ainda válido, devolve; se expirado, informa.
+    Devolve ETag; com If-None-Match igual responde 304.
     """
-    trials = _load_trials()
+    existing = await run_in_threadpool(_STORE.get_trial, req.machine_id)
 
-    # Owner: usa /trial (mesma lógica) de forma segura
-    if _is_owner(req.machine_id):
-        return trial(TrialRequest(machine_id=req.machine_id, product=req.product))
+    # Owner: mesma lógica do /trial, sem passar de novo pelo endpoint
+    if _is_owner(req.machine_id.strip()):
+        body = await _issue_or_get_owner(existing, req.machine_id, req.product, bg)
+        return _with_etag(body, if_none_match)
 
-    existing = trials.get(req.machine_id)
     if not existing:
         raise HTTPException(status_code=404, detail={"message": "Nenhuma licença encontrada para esta máquina."})
 
-    exp_dt = _parse_dt(existing.get("expires_at"))
-    if not exp_dt:
+    exp = _rec_expiry(existing)
+    if not exp:
         raise HTTPException(status_code=403, detail={"message": "Registro de licença inválido no servidor."})
 
-    if _utcnow() > exp_dt:
+    if time.time() > exp[0]:
         raise HTTPException(
             status_code=403,
             detail={
@@ -602,135 +1442,153 @@ def recover_license(req: RecoverRequest):
             },
         )
 
-    return {
+    body = {
         "license": existing.get("license"),
-        "expires_at": exp_dt.isoformat(),
+        "expires_at": exp[1],
         "machine_id": req.machine_id,
         "product": existing.get("product") or req.product,
         "plan": existing.get("plan") or "trial",
         "license_type": existing.get("license_type") or "trial",
     }
+    return _with_etag(body, if_none_match)
 
 # =========================
 # Validate
 # =========================
 
 @app.post("/validate")
-def validate(req: ValidateRequest):
+async def validate(req: ValidateRequest, if_none_match: str = Header(default="")):
     """
-    1) Se a licença existir no LICENSES_PATH (paid): valida por email/seats/active_mids no servidor.
+    1) Se a licença existir na tabela licenses (paid): valida por email/seats/active_mids no servidor.
     2) Se não existir: mantém a validação antiga (trial/owner) pelo parse.
+       Chave paid revogada (trocada no self_recover / apagada pelo admin) -> 403.
+    Chave paid pode ter qualquer formato (master keys B2B vêm do licenses.json),
+    então o lookup vem antes; texto fora do formato só é recusado no fallback.
+    Devolve a Response pronta: pula o jsonable_encoder (o corpo já é só str/None).
+    Só a resposta válida leva ETag/Cache-Control (304 se If-None-Match bater);
+    erros nunca são cacheados, então revogação/expiração aparecem no próximo check.
     """
     # 1) tenta validar como "paid" pelo registro do servidor
     try:
-        licenses_db = _load_licenses()
-        paid = licenses_db.get(req.license)
+        # no threadpool: _STORE.lock pode estar com um write_tx esperando o
+        # lock do SQLite (outro worker) e não pode travar o event loop
+        paid, revoked = await run_in_threadpool(_STORE.license_state, req.license)
         if paid:
             if paid.get("product") != req.product:
                 raise HTTPException(status_code=400, detail={"message": "Produto não confere."})
 
-            exp_dt = _parse_dt(paid.get("expires_at"))
-            if not exp_dt:
+            exp = _rec_expiry(paid)
+            if not exp:
                 raise HTTPException(status_code=403, detail={"message": "Registro de licença inválido no servidor."})
 
-            if _utcnow() > exp_dt:
-                raise HTTPException(status_code=403, detail={"message": "Licença expirada.", "expires_at": exp_dt.isoformat()})
+            if time.time() > exp[0]:
+                raise HTTPException(status_code=403, detail={"message": "Licença expirada.", "expires_at": exp[1]})
 
             mids = paid.get("active_mids") or []
             if req.machine_id not in mids:
                 raise HTTPException(status_code=403, detail={"message": "Esta máquina não está autorizada (seat não vinculado)."})
 
-            return {
+            return _with_etag({
                 "status": "valid",
                 "machine_id": req.machine_id,
-                "expires_at": exp_dt.isoformat(),
+                "expires_at": exp[1],
                 "plan": paid.get("plan") or "paid",
                 "license_type": paid.get("license_type") or "paid",
-            }
+            }, if_none_match, req.license)
     except HTTPException:
         raise
-    except Exception:
-        # se der qualquer erro lendo paid, cai pro fluxo antigo
-        pass
+    except Exception as e:
+        # sem ler o registro não dá para saber se a chave foi revogada: falha fechada
+        print(f"[WARN] validate: falha lendo licença no store: {e!r}")
+        raise HTTPException(status_code=503, detail={"message": "Falha ao consultar a licença. Tente novamente."})
+
+    # chave paid trocada (self_recover) ou apagada pelo admin: não cai no fallback
+    if revoked:
+        raise HTTPException(status_code=403, detail={"message": "Licença revogada."})
 
-    # 2) fluxo antigo (trial/owner)
+    # 2) fluxo antigo (trial/owner): parse em cache; fora do formato -> 400 sem mais banco
     try:
         parsed = _parse_license(req.license)
     except Exception:
         raise HTTPException(status_code=400, detail={"message": "Licença inválida."})
 
-    if parsed["product"] != req.product:
+    if parsed.product != req.product:
         raise HTTPException(status_code=400, detail={"message": "Produto não confere."})
 
-    if parsed["machine_id"] != req.machine_id:
+    if parsed.machine_id != req.machine_id:
         raise HTTPException(status_code=403, detail={"message": "Licença não pertence a esta máquina."})
 
-    if _utcnow() > parsed["exp"]:
+    if time.time() > parsed.exp_epoch:
         raise HTTPException(
             status_code=403,
-            detail={"message": "Licença expirada.", "expires_at": parsed["exp"].isoformat()},
+            detail={"message": "Licença expirada.", "expires_at": parsed.exp_iso},
         )
 
+    # metadado opcional: lookup pela PK trazendo só as 2 colunas, e só se a
+    # licença bater (threadpool pelo mesmo motivo do lookup paid)
     plan = None
     license_type = None
+    meta = None
     try:
-        trials = _load_trials()
-        rec = trials.get(req.machine_id) or {}
-        if rec.get("license") == req.license:
-            plan = rec.get("plan")
-            license_type = rec.get("license_type")
+        meta = await run_in_threadpool(_STORE.trial_meta, req.machine_id, req.license)
+        if meta:
+            plan, license_type = meta
     except Exception:
         pass
 
-    if not plan and _is_owner(req.machine_id):
+    # assinatura inválida: só aceita licença antiga (pré-HMAC) emitida por nós
+    if parsed.mac_ok is False and meta is None:
+        raise HTTPException(status_code=403, detail={"message": "Licença inválida."})
+
+    if not plan and _is_owner(req.machine_id.strip()):
         plan = "owner"
         license_type = "owner"
 
-    return {
+    return _with_etag({
         "status": "valid",
         "machine_id": req.machine_id,
-        "expires_at": parsed["exp"].isoformat(),
+        "expires_at": parsed.exp_iso,
         "plan": plan,
         "license_type": license_type,
-    }
+    }, if_none_match, req.license)
 
 # =========================
 # Activate (AGORA: gera licença paga + registra no servidor)
 # =========================
 @app.post("/activate")
-def activate(req: ActivateRequest):
+def activate(req: ActivateRequest, bg: BackgroundTasks):
     """
     Cria uma licença paga:
-    - salva em licenses.json com email, seats_total, active_mids, last_change_at
+    - salva na tabela licenses com email, seats_total, active_mids, last_change_at
     - mantém o trial/owner intacto
     """
     if req.seats_total < 1:
         raise HTTPException(status_code=400, detail={"message": "seats_total deve ser >= 1."})
     if req.days < 1:
         raise HTTPException(status_code=400, detail={"message": "days deve ser >= 1."})
-    if "@" not in req.email:
-        raise HTTPException(status_code=400, detail={"message": "email inválido."})
 
     lic = _make_license(machine_id=req.machine_id, product=req.product, days=req.days)
-    exp = _parse_license(lic)["exp"]
+    parsed = _parse_license(lic)
+    exp = parsed.exp
 
-    licenses_db = _load_licenses()
-    licenses_db[lic] = {
+    _STORE.put_license(lic, {
         "product": req.product,
-        "email": _email_norm(req.email),
+        "email": req.email,
         "license": lic,
-        "issued_at": _utcnow().isoformat(),
+        "issued_at": _utcnow_iso(),
         "expires_at": exp.isoformat(),
+        "expires_at_epoch": parsed.exp_epoch,
         "plan": "paid",
         "license_type": "paid",
         "seats_total": int(req.seats_total),
         "active_mids": [req.machine_id],
         "last_change_at": None,
-    }
-    _save_licenses(licenses_db)
+    })
 
-    # --- e-mail transacional (backup) ---
-    _try_send_license_email(
+    # --- e-mail transacional (backup): depois da resposta ---
+    bg.add_task(
+        _try_send_license_email,
+        app.state.http,
         to_email=req.email,
         product=req.product,
         license_type="paid",
@@ -742,7 +1600,7 @@ def activate(req: ActivateRequest):
         "status": "activated",
         "machine_id": req.machine_id,
         "product": req.product,
-        "email": _email_norm(req.email),
+        "email": req.email,
         "seats_total": int(req.seats_total),
         "expires_at": exp.isoformat(),
         "license": lic,
@@ -752,13 +1610,13 @@ def activate(req: ActivateRequest):
 # Pull License (NOVO) - revalidar por email
 # =========================
 
-class PullLicenseRequest(BaseModel):
-    email: str
-    machine_id: str
+class PullLicenseRequest(_RequestModel):
+    email: EmailNorm
+    machine_id: MachineId
     product: str = "psicrocalc"
 
 @app.post("/pull_license")
-def pull_license(req: PullLicenseRequest):
+def pull_license(req: PullLicenseRequest, bg: BackgroundTasks):
     """
     Puxa licença válida pelo email.
     - Procura licença paid ativa pelo email + product.
@@ -767,56 +1625,148 @@ def pull_license(req: PullLicenseRequest):
     - Se não houver seat -> erro.
     """
 
-    email_norm = _email_norm(req.email)
-    licenses_db = _load_licenses()
+    # procura licença válida desse email (produto/email/validade filtrados no SQL);
+    # tudo numa transação para dois pulls simultâneos não estourarem os seats
+    with _STORE.write_tx():
+        for lic_key, rec in _STORE.find_licenses(req.product, req.email, valid_at=time.time()):
+            exp = _rec_expiry(rec)
+
+            active_mids = rec.get("active_mids") or []
+            seats_total = int(rec.get("seats_total") or 1)
+
+            # se já está ativo nesta máquina
+            if req.machine_id in active_mids:
+                return {
+                    "license": lic_key,
+                    "expires_at": exp[1],
+                    "plan": rec.get("plan") or "paid",
+                    "license_type": rec.get("license_type") or "paid",
+                    "machine_id": req.machine_id,
+                }
+
+            # se ainda há seat disponível
+            if len(active_mids) < seats_total:
+                active_mids.append(req.machine_id)
+                rec["active_mids"] = active_mids
+                _STORE.put_license(lic_key, rec)
+
+                # rede fora da transação: roda depois da resposta
+                bg.add_task(
+                    _try_log_activation_event,
+                    app.state.http,
+                    license_key=lic_key,
+                    machine_id=req.machine_id,
+                    activated_by=req.email,
+                    event="seat_consumed",
+                )
+
+                return {
+                    "license": lic_key,
+                    "expires_at": exp[1],
+                    "plan": rec.get("plan") or "paid",
+                    "license_type": rec.get("license_type") or "paid",
+                    "machine_id": req.machine_id,
+                }
+
+            # não há seat disponível
+            raise HTTPException(
+                status_code=403,
+                detail={
+                    "message": "Limite de máquinas atingido para esta licença.",
+                    "seats_total": seats_total,
+                    "active_mids": active_mids,
+                },
+            )
+
+        raise HTTPException(
+            status_code=404,
+            detail={"message": "Nenhuma licença ativa encontrada para este email."},
+        )
+
+#===========================
+
+@app.post("/pull_license_master")
+def pull_license_master(req: PullLicenseMasterRequest):
+    """
+    Empresa (B2B) - ativar/revalidar por MASTER KEY.
+    - Não depende de email para achar licença.
+    - Email 'activated_by' é opcional (auditoria + avisos).
+    - Consome seats por machine_id.
+    - Registra evento em license_activations (Supabase).
+    - Envia e-mail para financeiro + TI (se informado).
+    """
+
+    lic_key = req.license
+    activated_by_norm = req.activated_by or None
+
+    # ler -> consumir seat -> gravar numa transação só
+    with _STORE.write_tx():
+        rec = _STORE.get_license(lic_key)
+
+        if not rec:
+            raise HTTPException(status_code=404, detail={"message": "Licença não encontrada."})
 
-    # procura licença válida desse email
-    for lic_key, rec in licenses_db.items():
         if rec.get("product") != req.product:
-            continue
-        if _email_norm(rec.get("email")) != email_norm:
-            continue
+            raise HTTPException(status_code=404, detail={"message": "Licença não encontrada para este produto."})
 
-        exp_dt = _parse_dt(rec.get("expires_at"))
-        if not exp_dt or _utcnow() > exp_dt:
-            continue  # ignorar expiradas
+        exp = _rec_expiry(rec)
+        if not exp or time.time() > exp[0]:
+            raise HTTPException(status_code=403, detail={"message": "Licença expirada."})
 
         active_mids = rec.get("active_mids") or []
         seats_total = int(rec.get("seats_total") or 1)
 
-        # se já está ativo nesta máquina
+        # Já ativo nesta máquina -> só retorna
         if req.machine_id in active_mids:
             return {
                 "license": lic_key,
-                "expires_at": exp_dt.isoformat(),
+                "expires_at": exp[1],
                 "plan": rec.get("plan") or "paid",
                 "license_type": rec.get("license_type") or "paid",
                 "machine_id": req.machine_id,
+                "seats_total": seats_total,
+                "seats_used": len(active_mids),
             }
 
-        # se ainda há seat disponível
+        # Tem seat disponível -> ativa
         if len(active_mids) < seats_total:
             active_mids.append(req.machine_id)
             rec["active_mids"] = active_mids
-            licenses_db[lic_key] = rec
-            _save_licenses(licenses_db)
-
-            _try_log_activation_event(
-                license_key=lic_key,
-                machine_id=req.machine_id,
-                activated_by=activated_by_norm,
-                event="seat_consumed",
-            )
+            rec["last_change_at"] = _utcnow_iso()
+
+            # opcional: guardar o último TI que ativou (útil pra aviso de vencimento depois)
+            if activated_by_norm:
+                rec["last_activated_by"] = activated_by_norm
+
+            _STORE.put_license(lic_key, rec)
+
+            # Log no Supabase (não derruba ativação se falhar)
+
+
+            # E-mails: financeiro sempre, TI se informado
+           # billing_email = rec.get("email")  # financeiro (comprador)
+            #_try_send_activation_notice(
+             #   billing_email=billing_email,
+              #  activated_by=activated_by_norm,
+               # product=req.product,
+                #license_key=lic_key,
+                #machine_id=req.machine_id,
+                #expires_at_iso=exp[1],
+                #seats_total=seats_total,
+                #seats_used=len(active_mids),
+           # )
 
             return {
                 "license": lic_key,
-                "expires_at": exp_dt.isoformat(),
+                "expires_at": exp[1],
                 "plan": rec.get("plan") or "paid",
                 "license_type": rec.get("license_type") or "paid",
                 "machine_id": req.machine_id,
+                "seats_total": seats_total,
+                "seats_used": len(active_mids),
             }
 
-        # não há seat disponível
+        # Sem seat
         raise HTTPException(
             status_code=403,
             detail={
@@ -826,174 +1776,86 @@ def pull_license(req: PullLicenseRequest):
             },
         )
 
-    raise HTTPException(
-        status_code=404,
-        detail={"message": "Nenhuma licença ativa encontrada para este email."},
-    )
-    
-#===========================
-
-@app.post("/pull_license_master")
-def pull_license_master(req: PullLicenseMasterRequest):
-    """
-    Empresa (B2B) - ativar/revalidar por MASTER KEY.
-    - Não depende de email para achar licença.
-    - Email 'activated_by' é opcional (auditoria + avisos).
-    - Consome seats por machine_id.
-    - Registra evento em license_activations (Supabase).
-    - Envia e-mail para financeiro + TI (se informado).
-    """
-
-    lic_key = (req.license or "").strip()
-    if not lic_key:
-        raise HTTPException(status_code=422, detail={"message": "license (master key) é obrigatório."})
-
-    activated_by_norm = _email_norm(req.activated_by) if req.activated_by else None
-
-    licenses_db = _load_licenses()
-    rec = licenses_db.get(lic_key)
-
-    if not rec:
-        raise HTTPException(status_code=404, detail={"message": "Licença não encontrada."})
-
-    if rec.get("product") != req.product:
-        raise HTTPException(status_code=404, detail={"message": "Licença não encontrada para este produto."})
-
-    exp_dt = _parse_dt(rec.get("expires_at"))
-    if not exp_dt or _utcnow() > exp_dt:
-        raise HTTPException(status_code=403, detail={"message": "Licença expirada."})
-
-    active_mids = rec.get("active_mids") or []
-    seats_total = int(rec.get("seats_total") or 1)
-
-    # Já ativo nesta máquina -> só retorna
-    if req.machine_id in active_mids:
-        return {
-            "license": lic_key,
-            "expires_at": exp_dt.isoformat(),
-            "plan": rec.get("plan") or "paid",
-            "license_type": rec.get("license_type") or "paid",
-            "machine_id": req.machine_id,
-            "seats_total": seats_total,
-            "seats_used": len(active_mids),
-        }
-
-    # Tem seat disponível -> ativa
-    if len(active_mids) < seats_total:
-        active_mids.append(req.machine_id)
-        rec["active_mids"] = active_mids
-        rec["last_change_at"] = _utcnow().isoformat()
-
-        # opcional: guardar o último TI que ativou (útil pra aviso de vencimento depois)
-        if activated_by_norm:
-            rec["last_activated_by"] = activated_by_norm
-
-        licenses_db[lic_key] = rec
-        _save_licenses(licenses_db)
-
-        # Log no Supabase (não derruba ativação se falhar)
-
-
-        # E-mails: financeiro sempre, TI se informado
-       # billing_email = rec.get("email")  # financeiro (comprador)
-        #_try_send_activation_notice(
-         #   billing_email=billing_email,
-          #  activated_by=activated_by_norm,
-           # product=req.product,
-            #license_key=lic_key,
-            #machine_id=req.machine_id,
-            #expires_at_iso=exp_dt.isoformat(),
-            #seats_total=seats_total,
-            #seats_used=len(active_mids),
-       # )
-
-        return {
-            "license": lic_key,
-            "expires_at": exp_dt.isoformat(),
-            "plan": rec.get("plan") or "paid",
-            "license_type": rec.get("license_type") or "paid",
-            "machine_id": req.machine_id,
-            "seats_total": seats_total,
-            "seats_used": len(active_mids),
-        }
-
-    # Sem seat
-    raise HTTPException(
-        status_code=403,
-        detail={
-            "message": "Limite de máquinas atingido para esta licença.",
-            "seats_total": seats_total,
-            "active_mids": active_mids,
-        },
-    )
-
 # =========================
 # Self Recover (NOVO) - rebind por email + cooldown 7d
 # =========================
 
 @app.post("/self_recover")
-def self_recover(req: SelfRecoverRequest):
+def self_recover(req: SelfRecoverRequest, bg: BackgroundTasks):
     """
     Recuperação por e-mail:
-    - encontra a licença em licenses.json
+    - encontra a licença no servidor
     - confere email
     - aplica cooldown de 7 dias
     - emite NOVA licença (com o new_machine_id no texto) mantendo a mesma expiração
     - seta active_mids = [new_machine_id]
     """
-    licenses_db = _load_licenses()
-    rec = licenses_db.get(req.license)
-    if not rec:
-        raise HTTPException(status_code=404, detail={"message": "Licença não encontrada no servidor."})
-
-    if rec.get("product") != req.product:
-        raise HTTPException(status_code=400, detail={"message": "Produto não confere."})
+    # ler -> checar cooldown -> trocar a chave numa transação só
+    with _STORE.write_tx():
+        rec = _STORE.get_license(req.license)
+        if not rec:
+            raise HTTPException(status_code=404, detail={"message": "Licença não encontrada no servidor."})
 
-    if _email_norm(rec.get("email")) != _email_norm(req.email):
-        raise HTTPException(status_code=403, detail={"message": "Email não confere com a licença."})
+        if rec.get("product") != req.product:
+            raise HTTPException(status_code=400, detail={"message": "Produto não confere."})
 
-    exp_dt = _parse_dt(rec.get("expires_at"))
-    if not exp_dt:
-        raise HTTPException(status_code=403, detail={"message": "Registro de licença inválido no servidor."})
+        if _email_norm(rec.get("email")) != req.email:
+            raise HTTPException(status_code=403, detail={"message": "Email não confere com a licença."})
 
-    if _utcnow() > exp_dt:
-        raise HTTPException(status_code=403, detail={"message": "Licença expirada.", "expires_at": exp_dt.isoformat()})
+        exp_dt = _parse_dt(rec.get("expires_at"))
+        if not exp_dt:
+            raise HTTPException(status_code=403, detail={"message": "Registro de licença inválido no servidor."})
+
+        # um instante só para o request: checagens e last_change_at batem entre si
+        now = _utcnow()
+        if now > exp_dt:
+            raise HTTPException(status_code=403, detail={"message": "Licença expirada.", "expires_at": exp_dt.isoformat()})
+
+        last_change = _parse_dt(rec.get("last_change_at"))
+        if last_change:
+            next_allowed = last_change + timedelta(days=COOLDOWN_DAYS)
+            if now < next_allowed:
+                raise HTTPException(
+                    status_code=403,
+                    detail={
+                        "message": "Troca de máquina em cooldown.",
+                        "next_change_allowed_at": next_allowed.isoformat(),
+                        "cooldown_days": COOLDOWN_DAYS,
+                    },
+                )
+        # mantém mesma expiração: gera licença nova com expiração fixa
+        new_license = _make_license_with_exp(
+            machine_id=req.new_machine_id,
+            product=req.product,
+            exp=exp_dt
+        )
 
-    last_change = _parse_dt(rec.get("last_change_at"))
-    if last_change:
-        next_allowed = last_change + timedelta(days=COOLDOWN_DAYS)
-        if _utcnow() < next_allowed:
-            raise HTTPException(
-                status_code=403,
-                detail={
-                    "message": "Troca de máquina em cooldown.",
-                    "next_change_allowed_at": next_allowed.isoformat(),
-                    "cooldown_days": COOLDOWN_DAYS,
-                },
-            )
-    # mantém mesma expiração: gera licença nova com expiração fixa
-    new_license = _make_license_with_exp(
-        machine_id=req.new_machine_id,
+        # remove a chave antiga e grava a nova (para não ficar duas licenças válidas)
+        _STORE.rekey_license(req.license, new_license, {
+            **rec,
+            "license": new_license,
+            "active_mids": [req.new_machine_id],
+            "last_change_at": now.isoformat(),
+            "expires_at": exp_dt.isoformat(),  # garante que não "estica" por erro
+            "expires_at_epoch": int(exp_dt.timestamp()),
+        })
+
+    # a chave mudou: manda a nova por e-mail como backup
+    bg.add_task(
+        _try_send_license_email,
+        app.state.http,
+        to_email=rec.get("email"),
         product=req.product,
-        exp=exp_dt
+        license_type=rec.get("license_type") or "paid",
+        license_key=new_license,
+        expires_at_iso=exp_dt.isoformat(),
     )
 
-    # remove a chave antiga e grava a nova (para não ficar duas licenças válidas)
-    licenses_db.pop(req.license, None)
-    licenses_db[new_license] = {
-        **rec,
-        "license": new_license,
-        "active_mids": [req.new_machine_id],
-        "last_change_at": _utcnow().isoformat(),
-        "expires_at": exp_dt.isoformat(),  # garante que não "estica" por erro
-    }
-    _save_licenses(licenses_db)
-
     return {
         "status": "recovered",
         "message": "Recuperação concluída. Nova licença emitida para a nova máquina.",
         "product": req.product,
-        "email": _email_norm(req.email),
+        "email": req.email,
         "expires_at": exp_dt.isoformat(),
         "cooldown_days": COOLDOWN_DAYS,
         "license": new_license,
@@ -1002,96 +1864,57 @@ def self_recover(req: SelfRecoverRequest):
 
 # ========= endpoint admin pra deletar
 
-class AdminDeleteLicenseRequest(BaseModel):
-    email: str
+class AdminDeleteLicenseRequest(_RequestModel):
+    email: EmailNorm
     product: str = "psicrocalc"
 
 @app.post("/admin/delete_license")
 def admin_delete_license(req: AdminDeleteLicenseRequest):
-    email_norm = _email_norm(req.email)
-    db = _load_licenses()
-
-    to_delete = []
-    for lic_key, rec in db.items():
-        if rec.get("product") != req.product:
-            continue
-        if _email_norm(rec.get("email")) != email_norm:
-            continue
-        to_delete.append(lic_key)
+    to_delete = _STORE.delete_licenses_matching(req.product, email=req.email)
 
     if not to_delete:
         raise HTTPException(status_code=404, detail={"message": "Nenhuma licença encontrada para este email/produto."})
 
-    for k in to_delete:
-        db.pop(k, None)
-
-    _save_licenses(db)
-
     return {"deleted": to_delete, "count": len(to_delete)}
 
 #============admin/delete_by_mid
 
-from pydantic import BaseModel
-from fastapi import HTTPException
-
-class AdminDeleteByMIDRequest(BaseModel):
-    machine_id: str
+class AdminDeleteByMIDRequest(_RequestModel):
+    machine_id: StrippedMachineId
     product: str = "psicrocalc"
 
 @app.post("/admin/delete_by_mid")
 def admin_delete_by_mid(req: AdminDeleteByMIDRequest):
-    mid = (req.machine_id or "").strip()
-    if not mid:
-        raise HTTPException(status_code=422, detail={"message": "machine_id obrigatório"})
-
-    db = _load_licenses()
-    to_delete = []
-
-    for lic_key, rec in db.items():
-        if rec.get("product") != req.product:
-            continue
-
-        # caso 1: a licença guarda machine_id "principal"
-        if (rec.get("machine_id") or "").strip() == mid:
-            to_delete.append(lic_key)
-            continue
+    mid = req.machine_id
 
-        # caso 2: a licença guarda lista de máquinas ativas
-        mids = rec.get("active_mids") or []
-        if mid in mids:
-            to_delete.append(lic_key)
+    # machine_id "principal" ou na lista de máquinas ativas (tabela license_seats)
+    to_delete = _STORE.delete_licenses_matching(req.product, machine_id=mid)
 
     if not to_delete:
         raise HTTPException(status_code=404, detail={"message": "Nenhuma licença encontrada para este MID/produto."})
-
-    for k in to_delete:
-        db.pop(k, None)
-
-    _save_licenses(db)
     return {"deleted": to_delete, "count": len(to_delete), "machine_id": mid}
 
 #=======================admin/delete_by_key
 
-class AdminDeleteByKeyRequest(BaseModel):
-    license_key: str
+class AdminDeleteByKeyRequest(_RequestModel):
+    license_key: StrippedLicenseText
 
 @app.post("/admin/delete_by_key")
 def admin_delete_by_key(req: AdminDeleteByKeyRequest):
-    key = (req.license_key or "").strip()
-    if not key:
-        raise HTTPException(status_code=422, detail={"message": "license_key obrigatório"})
+    key = req.license_key
 
-    db = _load_licenses()
-    if key not in db:
+    if not _STORE.delete_licenses([key]):
         raise HTTPException(status_code=404, detail={"message": "Licença não encontrada."})
 
-    db.pop(key, None)
-    _save_licenses(db)
     return {"deleted": key}
 # ========================
 # Admin: teste de envio de e-mail (Resend)
 # ========================
-class MailTestIn(BaseModel):
+# token próprio do mail_test (env ADMIN_TOKEN), lido uma vez no import como os demais
+_MAIL_TEST_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+_MAIL_TEST_TOKEN_BYTES = _MAIL_TEST_TOKEN.encode("utf-8")
+
+class MailTestIn(_RequestModel):
     to_email: EmailStr
     subject: str = "Teste Enviforge"
 
@@ -1104,31 +1927,23 @@ def _get_admin_token_from_request(request: Request, x_admin_token: str | None) -
 
 @app.post("/admin/mail_test")
 def admin_mail_test(payload: MailTestIn, request: Request, x_admin_token: str | None = Header(default=None, alias="X-Admin-Token")):
-    server_token = (os.getenv("ADMIN_TOKEN") or "").strip()
-    if not server_token:
+    if not _MAIL_TEST_TOKEN:
         raise HTTPException(status_code=500, detail="Admin token não configurado no servidor.")
 
     provided = _get_admin_token_from_request(request, x_admin_token)
-    if not provided or provided != server_token:
+    if not (provided and hmac.compare_digest(provided.encode("utf-8"), _MAIL_TEST_TOKEN_BYTES)):
         raise HTTPException(status_code=401, detail="Token admin inválido.")
 
-    mail_enabled = (os.getenv("MAIL_ENABLED") or "").strip().lower() == "true"
-    mail_from = (os.getenv("MAIL_FROM") or "").strip()
-    resend_api_key = (os.getenv("RESEND_API_KEY") or "").strip()
+    # mesma config do envio real (MAIL_ENABLED / MAIL_FROM / RESEND_API_KEY do import)
+    mail_from = MAIL_FROM
 
-    if not mail_enabled:
+    if not MAIL_ENABLED:
         raise HTTPException(status_code=400, detail="MAIL_ENABLED está desativado.")
     if not mail_from:
         raise HTTPException(status_code=500, detail="MAIL_FROM não configurado.")
-    if not resend_api_key:
+    if not RESEND_API_KEY:
         raise HTTPException(status_code=500, detail="RESEND_API_KEY não configurada.")
 
-    resend_url = "https://api.resend.com/emails"
-    headers = {
-        "Authorization": f"Bearer {resend_api_key}",
-        "Content-Type": "application/json",
-    }
-
     data = {
         "from": mail_from,                # ex: Enviforge <no-reply@enviforge.com>
         "to": [payload.to_email],
@@ -1137,7 +1952,7 @@ def admin_mail_test(payload: MailTestIn, request: Request, x_admin_token: str |
     }
 
     try:
-        r = requests.post(resend_url, headers=headers, json=data, timeout=20)
+        r = _HTTP.post(RESEND_EMAILS_URL, headers=_RESEND_HEADERS, content=_dump_json(data), timeout=20)
     except Exception as e:
         raise HTTPException(status_code=502, detail={"error": "Falha ao chamar Resend.", "exception": str(e)})
 
@@ -1177,7 +1992,7 @@ def admin_mail_test(payload: MailTestIn, request: Request, x_admin_token: str |
 # Admin: resetar trial de um machine_id (uso interno)
 # =========================
 @app.post("/admin/reset_trial")
-def admin_reset_trial(
+async def admin_reset_trial(
     req: AdminResetRequest,
     token: str = Query(default=""),
     x_admin_token: str = Header(default="", alias="X-Admin-Token"),
@@ -1196,15 +2011,13 @@ def admin_reset_trial(
     if not ADMIN_TOKEN:
         raise HTTPException(status_code=500, detail={"message": "Admin token não configurado no servidor."})
 
-    if provided != ADMIN_TOKEN:
+    # comparação em tempo constante; bytes para aceitar token com não-ASCII sem TypeError
+    if not (provided and hmac.compare_digest(provided.encode("utf-8"), _ADMIN_TOKEN_BYTES)):
         raise HTTPException(status_code=403, detail={"message": "Não autorizado."})
 
-    trials = _load_trials()
-    existed = req.machine_id in trials
+    removed = await run_in_threadpool(_STORE.delete_trial, req.machine_id)
 
-    if existed:
-        removed = trials.pop(req.machine_id)
-        _save_trials(trials)
+    if removed is not None:
         _log_admin(
             action="reset_trial",
             machine_id=req.machine_id,
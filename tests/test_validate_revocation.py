@@ -0,0 +1,71 @@
+"""
+Regressão: chave paid revogada (self_recover / admin delete) não pode voltar a
+validar com variações do mesmo texto (espaço/\\n nas pontas, token com lixo).
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp()
+os.environ["ENVIFORGE_LICENSE_SECRET"] = "test-secret"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+def _variants(lic: str) -> list[str]:
+    head, token = lic.rsplit("|", 1)
+    return [
+        lic,
+        lic + " ",
+        " " + lic,
+        lic + "\n",
+        f"{head}|{token[:5]}.{token[5:]}",  # caractere fora do base64url
+    ]
+
+
+class ValidateRevocationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(main.app)
+        cls.client.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.__exit__(None, None, None)
+
+    def _activate(self, mid: str, email: str) -> str:
+        r = self.client.post("/activate", json={"machine_id": mid, "email": email})
+        self.assertEqual(r.status_code, 200)
+        return r.json()["license"]
+
+    def _assert_rejected(self, mid: str, lic: str):
+        for text in _variants(lic):
+            r = self.client.post("/validate", json={"machine_id": mid, "license": text})
+            self.assertEqual(r.status_code, 403, repr(text))
+
+    def test_old_key_after_self_recover(self):
+        lic = self._activate("R1", "recover@x.com")
+        r = self.client.post(
+            "/self_recover",
+            json={"license": lic, "email": "recover@x.com", "new_machine_id": "R2"},
+        )
+        self.assertEqual(r.status_code, 200)
+        self._assert_rejected("R1", lic)
+
+        r = self.client.post("/validate", json={"machine_id": "R2", "license": r.json()["license"] + "\n"})
+        self.assertEqual(r.status_code, 200)
+
+    def test_key_after_admin_delete(self):
+        lic = self._activate("D1", "delete@x.com")
+        r = self.client.post("/admin/delete_by_key", json={"license_key": lic})
+        self.assertEqual(r.status_code, 200)
+        self._assert_rejected("D1", lic)
+
+
+if __name__ == "__main__":
+    unittest.main()